@@ -41,27 +41,124 @@ def get_nlp():
     return _nlp
 
 # ------------------------------------------------------------------
-# PII DETECTION (UNCHANGED)
+# PII DETECTION — SINGLE-PASS COMPILED SCANNER
 # ------------------------------------------------------------------
 
-def detect_pii(text: str) -> tuple:
-    """Detects PAN and Aadhaar in text. Returns (detected_list, confidence).
-    Confidence increases with number of PII types found.
+# One combined pattern so the text is walked exactly once. Alternatives are
+# ordered longest-first (GSTIN embeds a PAN) and the PAN / IFSC / GSTIN
+# branches are case-insensitive inline so no uppercase copy is needed.
+# Bank accounts are only taken when an account keyword precedes the digits,
+# otherwise every invoice / reference number would be reported.
+_PII_PATTERN = re.compile(
+    r"(?P<GSTIN>\b(?i:\d{2}[A-Z]{5}\d{4}[A-Z][1-9A-Z]Z[0-9A-Z])\b)"
+    r"|(?P<PAN>\b(?i:[A-Z]{3}[PCHFATBLJG][A-Z]\d{4}[A-Z])\b)"
+    r"|(?P<IFSC>\b(?i:[A-Z]{4}0[A-Z0-9]{6})\b)"
+    r"|(?i:\b(?:a/c|acc(?:oun)?t|acct)\.?(?:\s*(?:no|number|num)\.?)?\s*[:#-]?\s*)"
+    r"(?P<BANK_ACCOUNT>\d{9,18})\b"
+    r"|(?P<AADHAAR>\b[2-9]\d{3}(?P<sep>[\s-]?)\d{4}(?P=sep)\d{4})\b"
+)
+
+PII_LABELS = {
+    "PAN": "PAN_DETECTED",
+    "AADHAAR": "AADHAAR_DETECTED",
+    "GSTIN": "GSTIN_DETECTED",
+    "IFSC": "IFSC_DETECTED",
+    "BANK_ACCOUNT": "BANK_ACCOUNT_DETECTED",
+}
+
+# Verhoeff dihedral-group tables (UIDAI Aadhaar check digit)
+_VERHOEFF_D = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 2, 3, 4, 0, 6, 7, 8, 9, 5),
+    (2, 3, 4, 0, 1, 7, 8, 9, 5, 6),
+    (3, 4, 0, 1, 2, 8, 9, 5, 6, 7),
+    (4, 0, 1, 2, 3, 9, 5, 6, 7, 8),
+    (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2),
+    (7, 6, 5, 9, 8, 2, 1, 0, 4, 3),
+    (8, 7, 6, 5, 9, 3, 2, 1, 0, 4),
+    (9, 8, 7, 6, 5, 4, 3, 2, 1, 0),
+)
+_VERHOEFF_P = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 5, 7, 6, 2, 8, 3, 0, 9, 4),
+    (5, 8, 0, 3, 7, 9, 6, 1, 4, 2),
+    (8, 9, 1, 6, 0, 4, 3, 5, 2, 7),
+    (9, 4, 5, 3, 1, 2, 6, 8, 7, 0),
+    (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5),
+    (7, 0, 4, 6, 9, 1, 3, 2, 5, 8),
+)
+
+_GSTIN_CHARSET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def verhoeff_valid(digits: str) -> bool:
+    """Returns True if the digit string carries a valid Verhoeff check digit."""
+    c = 0
+    for i, ch in enumerate(reversed(digits)):
+        c = _VERHOEFF_D[c][_VERHOEFF_P[i % 8][ord(ch) - 48]]
+    return c == 0
+
+
+def gstin_valid(gstin: str) -> bool:
+    """Validates the 15th (base-36 Luhn mod N) check character of a GSTIN."""
+    gstin = gstin.upper()
+    total = 0
+    for i, ch in enumerate(gstin[:14]):
+        product = _GSTIN_CHARSET.index(ch) * (2 if i % 2 else 1)
+        total += product // 36 + product % 36
+    return gstin[14] == _GSTIN_CHARSET[(36 - total % 36) % 36]
+
+
+def _validate_pii(kind: str, value: str) -> bool:
+    if kind == "AADHAAR":
+        return verhoeff_valid(value.replace(" ", "").replace("-", ""))
+    if kind == "GSTIN":
+        return gstin_valid(value)
+    return True
+
+
+def scan_pii(text: str) -> List[Dict]:
     """
-    detected = []
-
+    Scans text once and returns every validated PII match in document order.
+    Each match is {"type", "value", "start", "end"} with offsets into `text`.
+    """
+    matches = []
     if not text:
-        return detected, 0.0
+        return matches
+
+    for m in _PII_PATTERN.finditer(text):
+        kind = m.lastgroup
+        value = m.group(kind)
+        if not _validate_pii(kind, value):
+            continue
+        start, end = m.span(kind)
+        matches.append({"type": kind, "value": value, "start": start, "end": end})
+
+    return matches
 
-    if re.findall(r'\b[A-Z]{5}[0-9]{4}[A-Z]{1}\b', text.upper()):
-        detected.append("PAN_DETECTED")
 
-    aadhaar_pattern = r'\b\d{4}[\s-]?\d{4}[\s-]?\d{4}\b'
-    if re.findall(aadhaar_pattern, text):
-        detected.append("AADHAAR_DETECTED")
+def scan_pii_batch(texts: List[str]) -> List[List[Dict]]:
+    """Batch form of scan_pii for many texts (e.g. per-page OCR output)."""
+    return [scan_pii(text) for text in texts]
+
+
+def detect_pii(text: str) -> tuple:
+    """Detects PAN, Aadhaar, GSTIN, IFSC and bank accounts in text.
+    Returns (detected_list, confidence, matches).
+    Confidence increases with number of PII types found.
+    """
+    matches = scan_pii(text)
+
+    detected = []
+    for match in matches:
+        label = PII_LABELS[match["type"]]
+        if label not in detected:
+            detected.append(label)
 
     confidence = 0.75 if len(detected) == 1 else (0.95 if len(detected) > 1 else 0.0)
-    return detected, confidence
+    return detected, confidence, matches
 
 # ------------------------------------------------------------------
 # ADVANCED NLP ENTITY EXTRACTION (UNCHANGED LOGIC)
@@ -116,9 +213,8 @@ def analyze_metadata(file_bytes: bytes, extracted_text: str) -> tuple:
                 confidence = 0.92 if year_diff >= 4 else 0.78
                 return "METADATA_MISMATCH: Hidden year is later than document year", confidence
 
-        creator = str(meta.get('/Creator', '')).lower()
-        if 'canva' in creator:
-            return "SUSPICIOUS_CREATOR_TOOL: Canva", 0.85
+        # Creator / Producer tool signatures are matched by the tampering
+        # signature engine in image_forensics.detect_tampering
 
     except Exception:
         pass
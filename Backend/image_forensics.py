@@ -3,12 +3,21 @@ image_forensics.py - Deep + Classical Image Tampering Detection
 Requirement: The Fraud Detective & The Duplicate Hunter
 """
 import io
+import os
+import json
+import logging
 import numpy as np
-from PIL import Image, ImageChops
-from typing import Optional
+from PIL import Image, ImageChops, ImageOps
+from typing import Optional, List, Dict
 import cv2
 import imagehash
 import piexif
+import pytesseract
+import ahocorasick
+from pypdf import PdfReader
+
+# Configure logging
+logger = logging.getLogger(__name__)
 
 try:
     from pdf2image import convert_from_bytes
@@ -41,9 +50,364 @@ def get_image_phash(file_bytes: bytes, filename: str = "") -> str:
     except Exception:
         return ""
 
+# ------------------------------------------------------------------
+# OCR NORMALIZATION (RESIZE, DESKEW, BINARIZE, TEXT REGIONS)
+# ------------------------------------------------------------------
+
+# Median glyph height band Tesseract reads well. Phone photos arrive with
+# text far above it, which only costs time; tiny scans are upscaled.
+OCR_TARGET_TEXT_HEIGHT = 24
+OCR_MIN_TEXT_HEIGHT = 10
+OCR_ANALYSIS_SIDE = 1600
+OCR_MAX_SIDE = 3500
+OCR_TIMEOUT_SECONDS = int(os.getenv("OCR_TIMEOUT_SECONDS", "20"))
+
+def _binarize(gray: np.ndarray, text_height: float) -> np.ndarray:
+    """
+    Adaptive threshold for layout analysis only (text regions, skew); returns
+    text as white (255) on black. The window spans about two glyphs and the
+    offset is small so faint photocopy strokes still register.
+    """
+    block = max(3, int(text_height * 2) | 1)
+    return cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, block, 5
+    )
+
+def _estimate_text_height(gray: np.ndarray) -> Optional[float]:
+    """Median glyph height in pixels, measured on a downscaled copy."""
+    scale = min(1.0, OCR_ANALYSIS_SIDE / max(gray.shape))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    _, _, stats, _ = cv2.connectedComponentsWithStats(_binarize(small, 15), connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    glyphs = (heights >= 4) & (heights <= small.shape[0] // 8) & (widths >= 2) & (widths <= small.shape[1] // 8)
+    if glyphs.sum() < 10:
+        return None
+    return float(np.median(heights[glyphs])) / scale
+
+def _text_regions(binary: np.ndarray) -> List[tuple]:
+    """Bounding boxes of text blocks, found by smearing glyphs into lines."""
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (OCR_TARGET_TEXT_HEIGHT, OCR_TARGET_TEXT_HEIGHT // 3))
+    contours, _ = cv2.findContours(cv2.dilate(binary, kernel), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = [cv2.boundingRect(c) for c in contours]
+    return [(x, y, w, h) for x, y, w, h in boxes if h >= OCR_MIN_TEXT_HEIGHT // 2 and w >= OCR_MIN_TEXT_HEIGHT]
+
+def _profile_score(binary: np.ndarray, angle: float) -> float:
+    h, w = binary.shape
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    rotated = cv2.warpAffine(binary, matrix, (w, h), flags=cv2.INTER_NEAREST, borderValue=0)
+    return float(np.var(rotated.sum(axis=1, dtype=np.float64)))
+
+def _skew_angle(binary: np.ndarray) -> float:
+    """
+    Projection-profile deskew: the rotation whose row sums are sharpest lines
+    the text up horizontally. Searched coarse-to-fine on a downscaled copy.
+    """
+    scale = min(1.0, 1000 / max(binary.shape))
+    small = cv2.resize(binary, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else binary
+    if cv2.countNonZero(small) < 100:
+        return 0.0
+
+    best = max(np.arange(-15, 15.5, 1.0), key=lambda a: _profile_score(small, a))
+    best = max(np.arange(best - 1, best + 1.05, 0.1), key=lambda a: _profile_score(small, a))
+    return float(best) if abs(best) >= 0.3 else 0.0
+
+def preprocess_for_ocr(img: Image.Image) -> Optional[Image.Image]:
+    """
+    Normalizes an image for Tesseract: applies EXIF orientation, rescales so
+    text lands between OCR_MIN_TEXT_HEIGHT and OCR_TARGET_TEXT_HEIGHT px,
+    deskews, and whites out everything outside the detected text regions,
+    cropped to them. The result stays grayscale: Tesseract's own Otsu
+    binarization keeps faint strokes that a fixed adaptive threshold loses.
+    Returns None when no text is found.
+    """
+    gray = np.array(ImageOps.exif_transpose(img).convert("L"))
+
+    text_height = _estimate_text_height(gray)
+    scale = 1.0
+    if text_height and text_height > OCR_TARGET_TEXT_HEIGHT:
+        scale = OCR_TARGET_TEXT_HEIGHT / text_height
+    elif text_height and text_height < OCR_MIN_TEXT_HEIGHT:
+        scale = min(2.0, OCR_MIN_TEXT_HEIGHT / text_height)
+    scale = min(scale, OCR_MAX_SIDE / max(gray.shape))
+    if abs(scale - 1.0) > 0.05:
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=interpolation)
+
+    scaled_height = text_height * scale if text_height else OCR_TARGET_TEXT_HEIGHT
+    # Masked-out areas are filled with the paper tone, not pure white, so
+    # Tesseract's global threshold does not mistake grey paper for ink
+    background = int(np.median(gray))
+    binary = _binarize(gray, scaled_height)
+    # Drop isolated speckles left by sensor noise and paper texture
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+
+    angle = _skew_angle(binary)
+    if angle:
+        h, w = binary.shape
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        binary = cv2.warpAffine(binary, matrix, (w, h), flags=cv2.INTER_NEAREST, borderValue=0)
+        gray = cv2.warpAffine(gray, matrix, (w, h), flags=cv2.INTER_LINEAR, borderValue=background)
+
+    regions = _text_regions(binary)
+    if not regions:
+        return None
+
+    masked = np.full_like(gray, background)
+    for x, y, w, h in regions:
+        masked[y:y + h, x:x + w] = gray[y:y + h, x:x + w]
+
+    pad = OCR_TARGET_TEXT_HEIGHT
+    x0 = max(0, min(x for x, _, _, _ in regions) - pad)
+    y0 = max(0, min(y for _, y, _, _ in regions) - pad)
+    x1 = min(masked.shape[1], max(x + w for x, _, w, _ in regions) + pad)
+    y1 = min(masked.shape[0], max(y + h for _, y, _, h in regions) + pad)
+
+    return Image.fromarray(masked[y0:y1, x0:x1])
+
+def ocr_image(img: Image.Image, timeout: int = OCR_TIMEOUT_SECONDS) -> str:
+    """Runs Tesseract on the normalized image with a hard per-image timeout."""
+    try:
+        prepared = preprocess_for_ocr(img)
+    except Exception as e:
+        logger.warning(f"OCR preprocessing failed, using raw grayscale: {e}")
+        prepared = img.convert("L")
+
+    if prepared is None:
+        return ""
+
+    try:
+        return pytesseract.image_to_string(prepared, timeout=timeout)
+    except RuntimeError as e:
+        # pytesseract kills the tesseract process and raises on timeout
+        logger.warning(f"OCR aborted after {timeout}s: {e}")
+        return ""
+
+# ------------------------------------------------------------------
+# TAMPERING SIGNATURE ENGINE (AHO-CORASICK)
+# ------------------------------------------------------------------
+
+# Sources a signature can be found in. Raw-byte hits are weaker evidence than
+# a tool declaring itself in a metadata field, so their confidence is scaled.
+SIGNATURE_SOURCES = ("metadata", "xmp", "pdf_info", "exif", "raw")
+SOURCE_WEIGHTS = {"metadata": 1.0, "xmp": 1.0, "pdf_info": 1.0, "exif": 0.97, "raw": 0.94}
+SOURCE_LABELS = {"metadata": "metadata", "xmp": "XMP metadata", "pdf_info": "PDF metadata", "raw": "raw file data"}
+
+# Override with a JSON list of the same shape via TAMPER_SIGNATURES_PATH.
+DEFAULT_SIGNATURES = [
+    {"pattern": "canva", "confidence": 0.93},
+    {"pattern": "photoshop", "confidence": 0.93},
+    {"pattern": "gimp", "confidence": 0.93},
+    {"pattern": "illustrator", "confidence": 0.93},
+    {"pattern": "framer", "confidence": 0.93},
+    # Acrobat / PDF Library producers and the JPEG APP14 "Adobe" marker are
+    # everywhere, so the bare vendor name only counts as declared software
+    {"pattern": "adobe", "confidence": 0.93, "sources": ["metadata", "exif"]},
+    # XMP namespace boilerplate: hits inside these spans are discarded
+    {"pattern": "adobe:ns:meta", "benign": True},
+    {"pattern": "ns.adobe.com", "benign": True},
+    {"pattern": "ns.adobe.com/photoshop", "benign": True},
+    # IPTC APP13 resource block header, written by many non-Adobe tools
+    {"pattern": "photoshop 3.0", "benign": True},
+    {"pattern": "xmlns:photoshop", "benign": True},
+    {"pattern": "photoshop:", "benign": True},
+]
+
+# Image info keys that are scanned as their own source or carry no tool names
+_SKIPPED_INFO_KEYS = {"exif", "xmp", "XML:com.adobe.xmp", "icc_profile"}
+
+# Inputs are lowercased one chunk at a time, so a large file is never copied whole
+SCAN_CHUNK_SIZE = 1 << 20
+
+
+def _is_letter(byte: int) -> bool:
+    return 65 <= byte <= 90 or 97 <= byte <= 122
+
+
+class SignatureMatcher:
+    """
+    Case-insensitive multi-pattern matcher over bytes (pyahocorasick).
+    One C-level Aho-Corasick pass per input, so cost does not grow with the
+    number of signatures. Tool signatures must stand alone as a word
+    ("canva" does not match "canvas"); benign spans match anywhere.
+    """
+
+    def __init__(self, signatures: List[Dict]):
+        self.signatures = []
+        self._automaton = ahocorasick.Automaton()
+
+        for sig in signatures:
+            # latin-1 maps each byte to one character, keeping byte offsets
+            pattern = sig["pattern"].lower().encode("utf-8").decode("latin-1")
+            if not pattern:
+                continue
+            self.signatures.append({
+                "name": sig["pattern"],
+                "length": len(pattern),
+                "confidence": float(sig.get("confidence", 0.0)),
+                "sources": set(sig.get("sources") or SIGNATURE_SOURCES),
+                "benign": bool(sig.get("benign", False)),
+            })
+            self._automaton.add_word(pattern, len(self.signatures) - 1)
+
+        self._max_length = max((s["length"] for s in self.signatures), default=1)
+        if self.signatures:
+            self._automaton.make_automaton()
+
+    def scan(self, data) -> List[tuple]:
+        """Returns (start, end, signature_index) for every match in `data`."""
+        if not self.signatures:
+            return []
+        if isinstance(data, str):
+            data = data.encode("utf-8", "ignore")
+
+        view = memoryview(data)
+        n = len(data)
+        overlap = self._max_length - 1
+        hits = []
+
+        for offset in range(0, n, SCAN_CHUNK_SIZE):
+            start = max(0, offset - overlap)
+            chunk = view[start:offset + SCAN_CHUNK_SIZE].tobytes().lower().decode("latin-1")
+            for last, idx in self._automaton.iter(chunk):
+                end = start + last + 1
+                if end <= offset:
+                    continue  # lies in the overlap, reported with the previous chunk
+                sig = self.signatures[idx]
+                begin = end - sig["length"]
+                if not sig["benign"] and (
+                    (begin > 0 and _is_letter(data[begin - 1])) or (end < n and _is_letter(data[end]))
+                ):
+                    continue
+                hits.append((begin, end, idx))
+
+        return hits
+
+
+def load_signature_db(path: Optional[str] = None) -> List[Dict]:
+    """Loads the signature list from JSON, falling back to DEFAULT_SIGNATURES."""
+    path = path or os.getenv("TAMPER_SIGNATURES_PATH")
+    if path:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not load tampering signatures from {path}: {e}")
+    return DEFAULT_SIGNATURES
+
+
+_matcher = SignatureMatcher(load_signature_db())
+
+
+def scan_signatures(sources: List[tuple], matcher: Optional[SignatureMatcher] = None) -> List[Dict]:
+    """
+    Scans (source, data) pairs and returns the tampering hits, one per
+    signature and source, with source-weighted confidence.
+    """
+    matcher = matcher or _matcher
+    results = []
+    seen = set()
+
+    for source, data in sources:
+        if not data:
+            continue
+        hits = matcher.scan(data)
+        benign = [(s, e) for s, e, idx in hits if matcher.signatures[idx]["benign"]]
+        for start, end, idx in hits:
+            sig = matcher.signatures[idx]
+            if sig["benign"] or source not in sig["sources"] or (sig["name"], source) in seen:
+                continue
+            if any(bs <= start and end <= be for bs, be in benign):
+                continue
+            seen.add((sig["name"], source))
+            results.append({
+                "signature": sig["name"],
+                "source": source,
+                "offset": start,
+                "confidence": round(sig["confidence"] * SOURCE_WEIGHTS.get(source, 1.0), 2),
+            })
+
+    return results
+
+
+def _image_signature_sources(file_bytes: bytes) -> List[tuple]:
+    sources = []
+    try:
+        img = Image.open(io.BytesIO(file_bytes))
+    except Exception:
+        # Not an image container (e.g. .doc / .docx): its bytes are document
+        # text, where tool names are ordinary words
+        return sources
+
+    sources.append(("raw", file_bytes))
+
+    for key, value in img.info.items():
+        if key not in _SKIPPED_INFO_KEYS and isinstance(value, (str, bytes)):
+            sources.append(("metadata", value))
+
+    sources.append(("xmp", img.info.get("xmp") or img.info.get("XML:com.adobe.xmp")))
+
+    if "exif" in img.info:
+        try:
+            zeroth = piexif.load(img.info["exif"]).get("0th", {})
+            for tag in (piexif.ImageIFD.Software, piexif.ImageIFD.ProcessingSoftware):
+                sources.append(("exif", zeroth.get(tag)))
+        except Exception:
+            pass
+
+    return sources
+
+
+def _pdf_signature_sources(file_bytes: bytes) -> List[tuple]:
+    sources = [("raw", file_bytes)]
+    try:
+        reader = PdfReader(io.BytesIO(file_bytes))
+    except Exception:
+        return sources
+
+    # Only the declared tools; Title / Subject / Keywords are free text
+    try:
+        meta = reader.metadata or {}
+        for key in ("/Creator", "/Producer"):
+            if meta.get(key):
+                sources.append(("pdf_info", str(meta[key])))
+    except Exception:
+        pass
+
+    # XMP streams are usually Flate-compressed, so the raw scan cannot see them
+    try:
+        xmp = reader.trailer["/Root"].get("/Metadata")
+        if xmp is not None:
+            sources.append(("xmp", xmp.get_object().get_data()))
+    except Exception:
+        pass
+
+    return sources
+
+
 def detect_tampering(file_bytes: bytes, filename: str) -> tuple:
+    """
+    Requirement: The Fraud Detective.
+    Signature scan over metadata, XMP, EXIF / PDF info and the original
+    bytes; falls back to ELA on the image (first page render for PDFs).
+    Returns (message, confidence) or (None, 0.0).
+    """
     name = filename.lower()
-    if name.endswith(".pdf") and PDF2IMAGE_AVAILABLE:
+    is_pdf = name.endswith(".pdf")
+
+    sources = _pdf_signature_sources(file_bytes) if is_pdf else _image_signature_sources(file_bytes)
+    hits = scan_signatures(sources)
+
+    if hits:
+        hit = max(hits, key=lambda h: h["confidence"])
+        if hit["source"] == "exif":
+            return f"Metadata Fraud: Software signature '{hit['signature']}' detected", hit["confidence"]
+        label = SOURCE_LABELS.get(hit["source"], hit["source"])
+        return f"Tampering Signature: '{hit['signature']}' marker found in {label}", hit["confidence"]
+
+    if is_pdf:
+        if not PDF2IMAGE_AVAILABLE:
+            return None, 0.0
         try:
             pages = convert_from_bytes(file_bytes, dpi=150, first_page=1, last_page=1)
             buf = io.BytesIO()
@@ -52,35 +416,6 @@ def detect_tampering(file_bytes: bytes, filename: str) -> tuple:
         except Exception:
             return None, 0.0
 
-    try:
-        img = Image.open(io.BytesIO(file_bytes))
-        
-        # 1. Deep Metadata Scan (FIXED for clean output)
-        suspicious_list = ["canva", "photoshop", "gimp", "adobe", "illustrator", "framer"]
-        for key, value in img.info.items():
-            if isinstance(value, (str, bytes)):
-                val_str = str(value).lower()
-                for tool in suspicious_list:
-                    if tool in val_str:
-                        # Return ONLY the tool name instead of the whole metadata block
-                        return f"Tampering Signature: '{tool}' marker found in metadata", 0.93
-
-        # 2. Raw Binary Signature Scan
-        raw_data = file_bytes.lower()
-        for tool in suspicious_list:
-            if tool.encode() in raw_data:
-                return f"Tampering Signature: '{tool}' marker found in raw file data", 0.87
-
-        # 3. Standard EXIF Scan
-        if "exif" in img.info:
-            exif = piexif.load(img.info["exif"])
-            software = exif.get("0th", {}).get(piexif.ImageIFD.Software, b"").decode().lower()
-            for tool in suspicious_list:
-                if tool in software:
-                    return f"Metadata Fraud: Software signature '{tool}' detected", 0.90
-    except Exception:
-        pass
-
     return detect_ela(file_bytes)
 
 def detect_ela(file_bytes: bytes, threshold: float = 30.0) -> tuple:
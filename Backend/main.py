@@ -1,29 +1,41 @@
 # main.py
 import io
+import time
 import uuid
+import asyncio
 import re
 import hashlib
-import docx
 import os
+import shutil
+import zipfile
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
 import json
+import logging
 import faiss
 import threading
+from collections import deque
 from datetime import datetime
 from typing import List, Optional
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, status
+from fastapi import FastAPI, UploadFile, File, HTTPException, status, BackgroundTasks, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import pdfplumber
-import pytesseract
 from PIL import Image
 from pypdf import PdfReader
 
 # Importing your custom logic
-from vector_store import search_duplicate, add_to_index
+from vector_store import search_fingerprint_duplicate, search_semantic_duplicate, add_to_index
 from fraud_detection import detect_pii, analyze_metadata, extract_advanced_entities
-from image_forensics import detect_tampering, get_image_phash
+from image_forensics import detect_tampering, get_image_phash, ocr_image
 from pydantic import BaseModel, Field
 
+# Configure logging
+logger = logging.getLogger(__name__)
+
 # ------------------------------------------------------------------
 # SYSTEM RESET LOGIC (MANUAL ONLY – SAFE FOR CLOUD)
 # ------------------------------------------------------------------
@@ -32,24 +44,25 @@ def reset_system_data():
     global db
     db.clear()
 
-    try:
-        with open("hash.json", "w") as f:
-            json.dump({}, f)
-    except Exception:
-        pass
+    with index_lock:
+        try:
+            with open("hash.json", "w") as f:
+                json.dump({}, f)
+        except Exception:
+            pass
 
-    try:
-        with open("sha256.json", "w") as f:
-            json.dump({}, f)
-    except Exception:
-        pass
+        try:
+            with open("sha256.json", "w") as f:
+                json.dump({}, f)
+        except Exception:
+            pass
 
-    try:
-        dimension = 384
-        index = faiss.IndexFlatIP(dimension)
-        faiss.write_index(index, "docs.index")
-    except Exception:
-        pass
+        try:
+            dimension = 384
+            index = faiss.IndexFlatIP(dimension)
+            faiss.write_index(index, "docs.index")
+        except Exception:
+            pass
 
     return True
 
@@ -88,6 +101,11 @@ app.add_middleware(
 db = {}
 db_lock = threading.Lock()
 
+# vector_store keeps its fingerprints in files that are read, modified and
+# rewritten; scans run in worker threads, so the duplicate decision and the
+# index write must happen as one step
+index_lock = threading.Lock()
+
 # Maximum file size (10MB)
 MAX_FILE_SIZE = 10 * 1024 * 1024
 ALLOWED_EXTENSIONS = {".pdf", ".docx", ".doc", ".jpg", ".jpeg", ".png"}
@@ -132,31 +150,147 @@ def clean_text(text: str) -> str:
     cleaned = re.sub(r"\s+", " ", cleaned)
     return cleaned.strip()
 
-def extract_text_from_file(content: bytes, filename: str) -> str:
+# WordprocessingML element tags
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P, _W_T, _W_TBL, _W_TR, _W_TC = _W + "p", _W + "t", _W + "tbl", _W + "tr", _W + "tc"
+_W_GRIDSPAN, _W_VMERGE, _W_VAL = _W + "gridSpan", _W + "vMerge", _W + "val"
+_W_BREAKS = {_W + "tab", _W + "br", _W + "cr"}
+
+def extract_docx_content(content: bytes) -> tuple:
+    """
+    Streams word/document.xml out of the DOCX zip with iterparse instead of
+    building the python-docx object model. Returns (text, tables) where text
+    is in document order and tables match the pdfplumber shape (rows of
+    cells, None where a merged cell spans), so merged cells appear once.
+    """
+    parts, tables = [], []
+    paragraphs = []   # text buffers of open <w:p>, innermost last
+    # open tables: {"rows", "row", "cell", "span", "merged", "slot", "cell_slot"}; slots are
+    # reserved in tables / parts when an element opens so nested tables keep document order
+    table_stack = []
+    elements = []     # open XML elements, so finished blocks can be detached from their parent
+
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        with archive.open("word/document.xml") as stream:
+            for event, elem in ET.iterparse(stream, events=("start", "end")):
+                tag = elem.tag
+                if event == "start":
+                    elements.append(elem)
+                    if tag == _W_P:
+                        paragraphs.append([])
+                    elif tag == _W_TBL:
+                        tables.append(None)
+                        table_stack.append({"rows": [], "row": None, "cell": None, "span": 1, "merged": False,
+                                            "slot": len(tables) - 1, "cell_slot": None})
+                    elif tag == _W_TR and table_stack:
+                        table_stack[-1]["row"] = []
+                    elif tag == _W_TC and table_stack:
+                        parts.append(None)
+                        table_stack[-1].update(cell=[], span=1, merged=False, cell_slot=len(parts) - 1)
+                    continue
+
+                elements.pop()
+
+                if tag == _W_T:
+                    if paragraphs and elem.text:
+                        paragraphs[-1].append(elem.text)
+                elif tag in _W_BREAKS:
+                    if paragraphs:
+                        paragraphs[-1].append(" ")
+                elif tag == _W_GRIDSPAN and table_stack:
+                    table_stack[-1]["span"] = int(elem.get(_W_VAL, "1") or 1)
+                elif tag == _W_VMERGE and table_stack:
+                    # <w:vMerge/> without val="restart" continues the cell above
+                    table_stack[-1]["merged"] = elem.get(_W_VAL, "continue") != "restart"
+                elif tag == _W_P:
+                    text = "".join(paragraphs.pop()).strip()
+                    if text:
+                        if table_stack and table_stack[-1]["cell"] is not None:
+                            table_stack[-1]["cell"].append(text)
+                        elif paragraphs:
+                            paragraphs[-1].append(" " + text)
+                        else:
+                            parts.append(text)
+                elif tag == _W_TC and table_stack:
+                    table = table_stack[-1]
+                    text = " ".join(table["cell"])
+                    if table["merged"] or not text:
+                        table["row"].append(None)
+                    else:
+                        table["row"].append(text)
+                        parts[table["cell_slot"]] = text
+                    table["row"].extend([None] * (table["span"] - 1))
+                    table["cell"] = None
+                elif tag == _W_TR and table_stack:
+                    table_stack[-1]["rows"].append(table_stack[-1]["row"])
+                    table_stack[-1]["row"] = None
+                elif tag == _W_TBL:
+                    table = table_stack.pop()
+                    if any(cell for row in table["rows"] for cell in row):
+                        tables[table["slot"]] = table["rows"]
+
+                # Detach every finished paragraph, cell, row and table so memory is
+                # bounded by the open block rather than by the whole table or body
+                if tag in (_W_P, _W_TC, _W_TR, _W_TBL) and elements:
+                    elem.clear()
+                    elements[-1].remove(elem)
+
+    return clean_text(" ".join(p for p in parts if p)), [t for t in tables if t is not None]
+
+def extract_doc_content(content: bytes) -> tuple:
+    """
+    Legacy .doc handling, returning (text, tables). Files that are really
+    DOCX (renamed zips) use the DOCX extractor; Word 97-2003 binaries go
+    through antiword when installed, which yields text only.
+    """
+    if zipfile.is_zipfile(io.BytesIO(content)):
+        return extract_docx_content(content)
+
+    antiword = shutil.which("antiword")
+    if not antiword:
+        return "", []
+    try:
+        # antiword only reads from a file path, not stdin
+        with tempfile.NamedTemporaryFile(suffix=".doc") as tmp:
+            tmp.write(content)
+            tmp.flush()
+            result = subprocess.run(
+                [antiword, "-w", "0", tmp.name],
+                capture_output=True,
+                timeout=20,
+            )
+        if result.returncode != 0:
+            logger.warning(
+                f"antiword failed ({result.returncode}): {result.stderr.decode('utf-8', 'ignore').strip()}"
+            )
+            return "", []
+        return clean_text(result.stdout.decode("utf-8", "ignore")), []
+    except Exception as e:
+        logger.warning(f"Legacy .doc extraction failed: {e}")
+        return "", []
+
+def extract_content_from_file(content: bytes, filename: str) -> tuple:
+    """
+    Single extraction entry point. Returns (text, tables); tables come from
+    the Word document structure, while PDF tables are extracted separately
+    by pdfplumber later in the scan.
+    """
     name = filename.lower()
 
     if name.endswith((".jpg", ".jpeg", ".png")):
         try:
-            image = Image.open(io.BytesIO(content)).convert("L")
-            return clean_text(pytesseract.image_to_string(image))
+            image = Image.open(io.BytesIO(content))
+            return clean_text(ocr_image(image)), []
         except Exception:
-            return ""
+            return "", []
 
-    if name.endswith(".docx") or name.endswith(".doc"):
+    if name.endswith((".docx", ".doc")):
         try:
-            doc = docx.Document(io.BytesIO(content))
-            full_text = []
-            for para in doc.paragraphs:
-                if para.text.strip():
-                    full_text.append(para.text)
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        if cell.text.strip():
-                            full_text.append(cell.text)
-            return clean_text(" ".join(full_text))
+            if name.endswith(".docx"):
+                return extract_docx_content(content)
+            return extract_doc_content(content)
         except Exception:
-            return ""
+            return "", []
 
     if name.endswith(".pdf"):
         # Primary: extract selectable text layer
@@ -178,21 +312,21 @@ def extract_text_from_file(content: bytes, filename: str) -> str:
                 from pdf2image import convert_from_bytes
                 pages = convert_from_bytes(content, dpi=200, first_page=1, last_page=1)
                 if pages:
-                    ocr_text = pytesseract.image_to_string(pages[0].convert("L"))
+                    ocr_text = ocr_image(pages[0])
                     extracted = clean_text(ocr_text)
             except Exception:
                 pass
 
-        return extracted
+        return extracted, []
 
-    return ""
+    return "", []
 
 # ------------------------------------------------------------------
 # ADMIN RESET ROUTE (UNCHANGED)
 # ------------------------------------------------------------------
 
 @app.get("/api/v1/admin/reset")
-async def manual_reset(key: str):
+def manual_reset(key: str):
     """Admin reset endpoint - requires secret key from environment variable."""
     admin_key = os.getenv("ADMIN_RESET_KEY", "ap_finance_2025")
     if key != admin_key:
@@ -228,14 +362,137 @@ def get_dashboard_stats():
     }
 
 # ------------------------------------------------------------------
-# MAIN SCAN ROUTE (UNCHANGED LOGIC)
+# SCAN PROGRESS EVENTS (SERVER-SENT EVENTS)
+# ------------------------------------------------------------------
+
+# A channel is a server-issued uuid4; every scan uploaded with it publishes
+# its stage events there, so one EventSource covers any number of scans.
+# Only issued ids are accepted, so other clients' events can't be read by
+# guessing a short name.
+CHANNEL_HISTORY = 500
+CHANNEL_TTL_SECONDS = 15 * 60
+SSE_KEEPALIVE_SECONDS = 15
+
+event_channels = {}
+event_channels_lock = threading.Lock()
+
+def _get_channel(channel: str) -> Optional[dict]:
+    """Returns the channel record, or None if it was never issued or has
+    expired. Prunes idle channels. Caller holds the lock.
+    """
+    now = time.monotonic()
+    for key in [k for k, ch in event_channels.items()
+                if not ch["subscribers"] and now - ch["touched"] > CHANNEL_TTL_SECONDS]:
+        del event_channels[key]
+
+    ch = event_channels.get(channel)
+    if ch is not None:
+        ch["touched"] = now
+    return ch
+
+def _require_channel(channel: str):
+    with event_channels_lock:
+        if _get_channel(channel) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Unknown or expired channel id; request one from POST /api/v1/scan/channels"
+            )
+
+def publish_scan_event(channel: Optional[str], task_id: str, stage: str, data: dict):
+    """Records a stage event and wakes every subscriber. Safe from worker threads."""
+    if not channel:
+        return
+    with event_channels_lock:
+        ch = _get_channel(channel)
+        if ch is None:
+            return
+        ch["seq"] += 1
+        event = {"id": ch["seq"], "task_id": task_id, "stage": stage, "data": data}
+        ch["events"].append(event)
+        subscribers = list(ch["subscribers"])
+
+    for loop, queue in subscribers:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+        except RuntimeError:
+            pass  # subscriber's loop already closed
+
+def _format_sse(event: dict) -> str:
+    payload = json.dumps({"task_id": event["task_id"], "stage": event["stage"], **event["data"]}, default=str)
+    return f"id: {event['id']}\nevent: {event['stage']}\ndata: {payload}\n\n"
+
+@app.post("/api/v1/scan/channels")
+def create_scan_channel():
+    """Issues a channel id for /api/v1/scan/upload?channel= and the event stream."""
+    channel = str(uuid.uuid4())
+    with event_channels_lock:
+        _get_channel(channel)  # prune expired channels
+        event_channels[channel] = {
+            "events": deque(maxlen=CHANNEL_HISTORY), "seq": 0,
+            "subscribers": set(), "touched": time.monotonic(),
+        }
+    return {"channel": channel}
+
+@app.get("/api/v1/scan/events/{channel}")
+async def scan_events(channel: str, request: Request, last_event_id: Optional[str] = Header(None)):
+    """Streams stage events for every scan on the channel as text/event-stream.
+    Reconnecting clients resume after Last-Event-ID from the channel history.
+    """
+    try:
+        resume_after = int(last_event_id or 0)
+    except ValueError:
+        resume_after = 0
+
+    subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+    with event_channels_lock:
+        ch = _get_channel(channel)
+        if ch is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Unknown or expired channel id; request one from POST /api/v1/scan/channels"
+            )
+        backlog = [e for e in ch["events"] if e["id"] > resume_after]
+        ch["subscribers"].add(subscriber)
+
+    async def stream():
+        try:
+            for event in backlog:
+                yield _format_sse(event)
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscriber[1].get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _format_sse(event)
+        finally:
+            with event_channels_lock:
+                ch["subscribers"].discard(subscriber)
+                ch["touched"] = time.monotonic()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ------------------------------------------------------------------
+# MAIN SCAN ROUTE
 # ------------------------------------------------------------------
 
 @app.post("/api/v1/scan/upload")
-async def upload_scan(file: UploadFile = File(...)):
-    """Upload and scan a document for fraud detection."""
-    start_time = datetime.now()
-    
+async def upload_scan(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    channel: Optional[str] = None,
+):
+    """Upload and scan a document for fraud detection.
+    With `channel` (from POST /api/v1/scan/channels), returns immediately and streams stage events to
+    /api/v1/scan/events/{channel}; otherwise blocks until the scan finishes.
+    """
+    if channel is not None:
+        _require_channel(channel)
+
     # Validate filename exists
     filename = file.filename
     if not filename:
@@ -268,54 +525,134 @@ async def upload_scan(file: UploadFile = File(...)):
     
     task_id = str(uuid.uuid4())
 
-    # Compute SHA-256 fingerprint of raw file bytes (Layer 0 duplicate check)
-    sha256_hash = hashlib.sha256(content).hexdigest()
+    if channel:
+        with db_lock:
+            db[task_id] = {"file_id": task_id, "filename": filename, "status": "scanning"}
+        publish_scan_event(channel, task_id, "queued", {"filename": filename})
+        background_tasks.add_task(run_scan, content, filename, task_id, channel)
+        return {"task_id": task_id, "message": f"Scan started. Progress is streamed on channel '{channel}'."}
 
-    text = extract_text_from_file(content, filename)
-    entities = extract_advanced_entities(text)
+    await run_in_threadpool(run_scan, content, filename, task_id)
+    return {"task_id": task_id, "message": "Unified fraud analysis concluded."}
 
-    tables = []
-    if filename.lower().endswith(".pdf"):
-        try:
-            with pdfplumber.open(io.BytesIO(content)) as pdf:
-                tables = [p.extract_table() for p in pdf.pages if p.extract_table()]
-        except Exception:
-            pass
+def run_scan(content: bytes, filename: str, task_id: str, channel: Optional[str] = None) -> dict:
+    """
+    Runs every analyzer and stores the result in db. Checks that only need
+    the raw bytes (byte/visual duplicate, tampering) run before text
+    extraction so their stage events reach subscribers first.
+    """
+    start_time = datetime.now()
 
-    img_hash = get_image_phash(content, filename)
-    is_dup, dup_score = search_duplicate(text, img_hash, sha256_hash)
-    tamper_msg, tamper_conf = detect_tampering(content, filename)
-    meta_issue, meta_conf = analyze_metadata(content, text)
-    pii_found, pii_conf = detect_pii(text)
+    def emit(stage: str, **data):
+        publish_scan_event(channel, task_id, stage, data)
+
+    try:
+        result = _run_scan_stages(content, filename, task_id, start_time, emit)
+    except Exception as e:
+        failure = {"file_id": task_id, "filename": filename, "status": "error", "error": str(e)}
+        with db_lock:
+            db[task_id] = failure
+        emit("failed", error=str(e))
+        # In channel mode the response is already sent; the failed event
+        # and the db entry are how the client learns about it
+        if channel:
+            logger.exception(f"Scan {task_id} ({filename}) failed")
+            return failure
+        raise
+
+    with db_lock:
+        db[task_id] = result
+    emit(
+        "completed",
+        fraud_score=result["fraud_score"],
+        severity=result["severity"],
+        confidence=result["confidence"],
+        anomalies=result["anomalies"],
+        processing_time=result["processing_time"],
+    )
+    return result
 
+def _run_scan_stages(content: bytes, filename: str, task_id: str, start_time: datetime, emit) -> dict:
     fraud_score = 0
     anomalies = []
 
+    # Byte (SHA-256) and visual (pHash) duplicate layers need no text, so they
+    # run before OCR. Fingerprints of a new file are registered right away so
+    # a concurrent re-upload of the same file is caught without waiting for
+    # this scan's text extraction.
+    sha256_hash = hashlib.sha256(content).hexdigest()
+    img_hash = get_image_phash(content, filename)
+    with index_lock:
+        is_dup, dup_score = search_fingerprint_duplicate(img_hash, sha256_hash)
+        if not is_dup:
+            add_to_index("", img_hash, sha256_hash)
+    anomaly = None
+    if is_dup:
+        fraud_score = 100
+        anomaly = {"type": "Duplicate Discovery", "description": "Byte-level or visual match found.", "confidence": dup_score}
+        anomalies.append(anomaly)
+    emit("duplicate_check", is_duplicate=is_dup, anomaly=anomaly, fraud_score=fraud_score)
+
+    tamper_msg, tamper_conf = detect_tampering(content, filename)
+    anomaly = None
     if tamper_msg:
         fraud_score = max(fraud_score, 90)
-        anomalies.append({"type": "Forensic Tampering", "description": tamper_msg, "confidence": tamper_conf})
+        anomaly = {"type": "Forensic Tampering", "description": tamper_msg, "confidence": tamper_conf}
+        anomalies.append(anomaly)
+    emit("tampering", anomaly=anomaly, fraud_score=fraud_score)
 
-    if meta_issue:
-        fraud_score = max(fraud_score, 85)
-        anomalies.append({"type": "Metadata Fraud", "description": meta_issue, "confidence": meta_conf})
+    text, tables = extract_content_from_file(content, filename)
+    emit("text_extracted", characters=len(text))
 
-    if is_dup:
-        fraud_score = 100
-        anomalies.append({"type": "Duplicate Discovery", "description": "Visual or text match found.", "confidence": dup_score})
+    # Semantic layer — skipped when the file already matched byte for byte
+    # or visually, which also keeps duplicates out of the FAISS index
+    anomaly = None
+    if not is_dup:
+        with index_lock:
+            is_dup, dup_score = search_semantic_duplicate(text)
+            if not is_dup:
+                add_to_index(text, "", "")
+        if is_dup:
+            fraud_score = 100
+            anomaly = {"type": "Duplicate Discovery", "description": "Text match found.", "confidence": dup_score}
+            anomalies.append(anomaly)
+    emit("semantic_duplicate", is_duplicate=is_dup, anomaly=anomaly, fraud_score=fraud_score)
 
+    meta_issue, meta_conf = analyze_metadata(content, text)
+    anomaly = None
+    if meta_issue:
+        fraud_score = max(fraud_score, 85)
+        anomaly = {"type": "Metadata Fraud", "description": meta_issue, "confidence": meta_conf}
+        anomalies.append(anomaly)
+    emit("metadata", anomaly=anomaly, fraud_score=fraud_score)
+
+    pii_found, pii_conf, pii_matches = detect_pii(text)
+    # PII spans are offsets into text_content (values omitted on purpose)
+    pii_spans = [{"type": m["type"], "start": m["start"], "end": m["end"]} for m in pii_matches]
+    anomaly = None
     if pii_found:
-        anomalies.append({"type": "PII Detected", "description": f"Contains: {pii_found}", "confidence": pii_conf})
+        anomaly = {"type": "PII Detected", "description": f"Contains: {pii_found}", "confidence": pii_conf}
+        anomalies.append(anomaly)
         if fraud_score < 30:
             fraud_score += 20
+    emit("pii", detected=pii_found, matches=pii_spans, anomaly=anomaly, fraud_score=fraud_score)
 
-    severity = "CRITICAL" if fraud_score >= 70 else "WARNING" if fraud_score >= 30 else "SAFE"
+    entities = extract_advanced_entities(text)
+    emit("entities", entities=entities)
 
-    if not is_dup:
-        add_to_index(text, img_hash, sha256_hash)
+    if filename.lower().endswith(".pdf"):
+        try:
+            with pdfplumber.open(io.BytesIO(content)) as pdf:
+                tables = [p.extract_table() for p in pdf.pages if p.extract_table()]
+        except Exception:
+            pass
+    emit("tables", count=len(tables))
+
+    severity = "CRITICAL" if fraud_score >= 70 else "WARNING" if fraud_score >= 30 else "SAFE"
 
     overall_confidence = sum(a["confidence"] for a in anomalies) / len(anomalies) if anomalies else 0.0
 
-    result = {
+    return {
         "file_id": task_id,
         "filename": filename,
         "file_url": f"/api/v1/files/{task_id}",  # Virtual file reference
@@ -327,6 +664,7 @@ async def upload_scan(file: UploadFile = File(...)):
         "anomalies": anomalies,
         "text_content": text,
         "entities": entities,
+        "pii_matches": pii_spans,
         "extracted_tables": tables,
         "processing_time": int((datetime.now() - start_time).total_seconds() * 1000),
         "confidence": round(overall_confidence, 4),
@@ -334,10 +672,6 @@ async def upload_scan(file: UploadFile = File(...)):
         "scanned_at": datetime.now().isoformat(),
     }
 
-    with db_lock:
-        db[task_id] = result
-    return {"task_id": task_id, "message": "Unified fraud analysis concluded."}
-
 # ------------------------------------------------------------------
 # RESULT + HEALTH
 # ------------------------------------------------------------------
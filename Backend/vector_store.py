@@ -78,6 +78,16 @@ def search_duplicate(text: str, img_hash: str, sha256_hash: str = ""):
     Layer 1: pHash visual match (catches identical images/scanned pages).
     Layer 2: Semantic vector similarity via FAISS (catches same content, different format/scan).
     """
+    is_dup, score = search_fingerprint_duplicate(img_hash, sha256_hash)
+    if is_dup:
+        return is_dup, score
+    return search_semantic_duplicate(text)
+
+def search_fingerprint_duplicate(img_hash: str, sha256_hash: str = ""):
+    """
+    Layers 0 and 1 only. Needs no extracted text, so callers can run it
+    before OCR.
+    """
 
     # Layer 0 — SHA-256 exact match
     if sha256_hash and os.path.exists(SHA256_PATH):
@@ -101,6 +111,11 @@ def search_duplicate(text: str, img_hash: str, sha256_hash: str = ""):
         except (IOError, json.JSONDecodeError) as e:
             logger.warning(f"Failed to read hash file: {e}")
 
+    return False, 0.0
+
+def search_semantic_duplicate(text: str):
+    """Layer 2 only: nearest neighbour of the text in the FAISS index."""
+
     # Layer 2 — Semantic vector similarity
     # Skip if text is too short to be meaningful (e.g., OCR returned nothing)
     if not text or len(text.strip()) < 20:
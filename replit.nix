@@ -3,6 +3,7 @@
     pkgs.python311
     pkgs.tesseract
     pkgs.poppler_utils
+    pkgs.antiword
     pkgs.ffmpeg
     pkgs.libglvnd
   ];